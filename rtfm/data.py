@@ -5,10 +5,11 @@ import random
 from collections import defaultdict
 from dataclasses import dataclass
 from functools import partial
-from typing import Dict, Sequence, List, Union, Optional, Any, Tuple
+from typing import Dict, Sequence, List, Union, Optional, Any, Tuple, Iterator
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 import scipy
 import torch
 import transformers
@@ -21,6 +22,7 @@ from rtfm.configs import TrainConfig
 from rtfm.datasets import get_task_dataset
 from rtfm.datasets.data_utils import (
     make_object_json_serializable,
+    unique_json_serializable_values,
     df_to_records,
     build_formatted_df,
 )
@@ -186,11 +188,14 @@ class DatasetTypeError(TypeError):
     pass
 
 
-def build_formatted_df_from_file(file, data_args: DataArguments) -> pd.DataFrame:
+def build_formatted_df_from_file(
+    file, data_args: DataArguments, as_arrow: bool = False
+) -> Union[pd.DataFrame, pa.Table]:
     """Build a formatted DataFrame.
 
     The result of this function has columns 'data' and 'info', which are used for
-    downstream processing.
+    downstream processing. If as_arrow is True, a pyarrow Table with the same
+    columns is returned instead, which can be iterated over in record batches.
     """
     assert not data_args.use_metafeatures
 
@@ -212,35 +217,20 @@ def build_formatted_df_from_file(file, data_args: DataArguments) -> pd.DataFrame
         # TODO(jpgard): currently the below will fail with an AssertionError
         #  for columns where is_numeric(x) is True but pd.api.types.is_numeric_dtype(x) is False.
         df[target] = discretize_continuous_column(df[target], num_buckets=num_buckets)
-        target_column_unique_values = (
-            df[target].apply(make_object_json_serializable).unique()
-        )
+        target_column_unique_values = unique_json_serializable_values(df[target])
 
         logging.warning(
             f"transformed column {target} to have {num_buckets} buckets; printing the first few elements: {df[target][:5]}"
         )
 
-    info: List[str] = []
-
-    for _, row in df.iterrows():
-        # If the number of choices for the target column exceeds data_args.max_target_choices,
-        # take a uniform sample. Otherwise give the full list of choices for the column.
-        if len(target_column_unique_values) > data_args.max_target_choices:
-            target_value = make_object_json_serializable(row[target])
-            target_choices = [target_value] + np.random.choice(
-                [x for x in target_column_unique_values if x != target_value],
-                data_args.max_target_choices - 1,
-                replace=False,
-            ).tolist()
-        else:
-            target_choices = target_column_unique_values.tolist()
+    def _dump_info(target_choices) -> str:
         row_info = {
             "target": target,
             "target_choices": target_choices,
             "task": file,
         }
         try:
-            info.append(json.dumps(row_info))
+            return json.dumps(row_info)
         except TypeError as te:
             logging.warning(
                 f"got TypeError processing dataset {file}: {te}"
@@ -248,8 +238,25 @@ def build_formatted_df_from_file(file, data_args: DataArguments) -> pd.DataFrame
             )
             raise DatasetTypeError(str(te))
 
+    # If the number of choices for the target column exceeds data_args.max_target_choices,
+    # take a uniform sample for each row. Otherwise give the full list of choices for the
+    # column, which is identical for every row.
+    if len(target_column_unique_values) > data_args.max_target_choices:
+        info: List[str] = []
+        for target_value in df[target].apply(make_object_json_serializable):
+            target_choices = [target_value] + np.random.choice(
+                [x for x in target_column_unique_values if x != target_value],
+                data_args.max_target_choices - 1,
+                replace=False,
+            ).tolist()
+            info.append(_dump_info(target_choices))
+    else:
+        info = [_dump_info(target_column_unique_values.tolist())] * len(df)
+
     df_out = df_to_records(df)
     df_out["info"] = info
+    if as_arrow:
+        return pa.Table.from_pandas(df_out, preserve_index=False)
     return df_out
 
 
@@ -268,7 +275,11 @@ def prepare_hf_dataset_from_formatted_df(df, as_iterable: bool):
 
 
 def load_uncached_hf_dataset(
-    task: str, split: str, data_args: DataArguments, as_iterable: bool
+    task: str,
+    split: str,
+    data_args: DataArguments,
+    as_iterable: bool,
+    max_rows: Optional[int] = None,
 ) -> Union[Dataset, IterableDataset]:
     preprocessor_config = fetch_preprocessor_config_from_data_args(data_args, task)
     if data_args.from_files:
@@ -284,6 +295,14 @@ def load_uncached_hf_dataset(
             data_args,
         )
 
+    if max_rows is not None and len(df) > max_rows:
+        # Only a random subset of max_rows rows will be used downstream; sample it
+        # here instead of building and serializing the full dataset and then
+        # shuffling it to take the first max_rows elements. The index is set directly
+        # since reset_index() would copy the sampled rows again.
+        df = df.take(np.random.permutation(len(df))[:max_rows])
+        df.index = pd.RangeIndex(len(df))
+
     return prepare_hf_dataset_from_formatted_df(df, as_iterable)
 
 
@@ -369,6 +388,7 @@ def load_serialized_dataset(
     as_iterable: bool,
     print_one_example: bool = False,
     cfg: Optional[TLMConfig] = None,
+    max_rows: Optional[int] = None,
 ) -> Union[Dataset, IterableDataset]:
     """Load the serialized HF dataset for a task by fetching the HF dataset and serializing the results.
 
@@ -378,7 +398,11 @@ def load_serialized_dataset(
     """
 
     dataset = load_uncached_hf_dataset(
-        task=task, split=split, data_args=data_args, as_iterable=as_iterable
+        task=task,
+        split=split,
+        data_args=data_args,
+        as_iterable=as_iterable,
+        max_rows=max_rows,
     )
 
     if not cfg and not data_args.from_files:
@@ -398,6 +422,7 @@ def load_serialized_interleaved_dataset(
     as_iterable: bool,
     split="train",
     print_one_example=False,
+    max_rows_per_task: Optional[int] = None,
 ) -> Union[Dataset, IterableDataset]:
     """Serialize and interleave the examples from task_names.
 
@@ -419,6 +444,7 @@ def load_serialized_interleaved_dataset(
                 split=split,
                 as_iterable=as_iterable,
                 print_one_example=print_one_example,
+                max_rows=max_rows_per_task,
             )
             dsets[task] = dataset
         except NoTargetCandidatesError:
@@ -814,6 +840,11 @@ def load_tokenize_and_serialize_tabular_dataset(
 
     Interleaves datasets from all tasks in task_names.
     """
+    # When only max_samples examples are kept, only a random subset of each
+    # task's rows needs to be serialized and tokenized.
+    max_rows_per_task = None
+    if max_samples is not None and not as_iterable:
+        max_rows_per_task = max_samples * (data_arguments.num_shots + 1)
 
     ds_dict = {
         split: load_serialized_interleaved_dataset(
@@ -823,6 +854,7 @@ def load_tokenize_and_serialize_tabular_dataset(
             serializer=serializer,
             as_iterable=as_iterable,
             print_one_example=print_one_example,
+            max_rows_per_task=max_rows_per_task,
         ).shuffle()
         for split in splits
     }
@@ -901,6 +933,22 @@ def log_and_continue(exn):
     return True
 
 
+def _extract_json_records(samples) -> Iterator[Dict[str, str]]:
+    """Fetch the {'text': ..., 'class_label_as_text': ...} records of each sample.
+
+    A sample holds either a single JSON record, or several newline-delimited
+    JSON records (with extension 'jsonl')."""
+    for sample in samples:
+        jsonl_keys = [x for x in sample.keys() if x.endswith("jsonl")]
+        if jsonl_keys:
+            for line in sample[jsonl_keys[0]].splitlines():
+                yield json.loads(line.decode("utf-8"))
+        else:
+            key = [x for x in sample.keys() if x.endswith("json")][0]
+            json_bytes = sample[key]
+            yield json.loads(json_bytes.decode("utf-8"))
+
+
 def load_and_tokenize_preserialized_wds(
     tokenizer,
     urls: Sequence[str],
@@ -924,12 +972,6 @@ def load_and_tokenize_preserialized_wds(
         logging.warning(f"s3 file urls detected; attempting to pipe data from s3")
         urls = [f"pipe:aws s3 cp {url} -" for url in urls]
 
-    def _extract_json(sample) -> Dict[str, str]:
-        """Fetch the {'text': ..., 'class_label_as_text': ...} for a sample."""
-        key = [x for x in sample.keys() if x.endswith("json")][0]
-        json_bytes = sample[key]
-        return json.loads(json_bytes.decode("utf-8"))
-
     def _tokenize_fn(example):
         preprocessed = preprocess(
             [example["input_text"]],
@@ -1027,13 +1069,16 @@ def load_and_tokenize_preserialized_wds(
         ]
     )
 
+    pipeline.append(_extract_json_records)
+
     if shuffle_before_packing:
-        # This will pack random/unrelated samples together if activated
+        # This will pack random/unrelated samples together if activated. Shuffling
+        # happens after _extract_json_records so that individual records (not the
+        # multi-record JSONL samples they are stored in) are shuffled.
         pipeline.append(wds.shuffle(shuffle_buffer_size))
 
     pipeline.extend(
         [
-            wds.map(_extract_json),
             wds.map(add_qa_and_eoc_tokens_to_example),
             wds.map(_tokenize_fn),
         ]
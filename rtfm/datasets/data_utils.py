@@ -81,6 +81,21 @@ def make_object_json_serializable(x) -> Union[str, List[str]]:
         return str(x)
 
 
+def unique_json_serializable_values(ser: pd.Series) -> np.ndarray:
+    """Return the unique values of ser after making them JSON serializable.
+
+    This is equivalent to ser.apply(make_object_json_serializable).unique(), but for
+    integer and boolean (numpy) columns only the unique values are converted,
+    instead of every element of the column. Float columns take the slow path, since
+    pd.unique() merges -0.0 and 0.0, and its values are not converted exactly like
+    the elements of e.g. a float32 column."""
+    if isinstance(ser.dtype, np.dtype) and ser.dtype.kind in "iub":
+        return np.array(
+            [make_object_json_serializable(x) for x in pd.unique(ser)], dtype=object
+        )
+    return ser.apply(make_object_json_serializable).unique()
+
+
 def is_date_column(ser: pd.Series) -> bool:
     """More robust check of whether a column contains a date.
 
@@ -8,7 +8,7 @@ import numpy as np
 import pandas as pd
 from rtfm.arguments import DataArguments
 
-from rtfm.datasets.data_utils import is_date_column, make_object_json_serializable
+from rtfm.datasets.data_utils import is_date_column, unique_json_serializable_values
 
 
 def is_numeric_series(vals: Union[pd.Series, Sequence[str]]) -> bool:
@@ -41,9 +41,7 @@ class T4TargetSelector(TargetSelector):
         for c in df.columns:
             try:
                 # Check that the values of the target column are not too long.
-                unique_values_serializable = (
-                    df[c].apply(make_object_json_serializable).unique()
-                )
+                unique_values_serializable = unique_json_serializable_values(df[c])
 
                 if not is_valid_target_column(
                     self.data_args, df[c], unique_values_serializable
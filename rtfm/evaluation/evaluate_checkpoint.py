@@ -1,11 +1,13 @@
 """
 Evaluate a language model for tabular data prediction.
 """
+import importlib.util
 import logging
 import os
 from typing import Dict, Optional
 
 import pandas as pd
+import torch
 import transformers
 from llama_recipes.inference.model_utils import load_model
 from transformers import AutoTokenizer
@@ -16,9 +18,10 @@ from rtfm.arguments import (
 from rtfm.configs import TrainConfig, TokenizerConfig, SerializerConfig
 from rtfm.evaluation.evaluation_utils import (
     prepare_eval_kwargs,
-    prepare_eval_datasets,
+    iter_eval_datasets,
 )
 from rtfm.evaluation.evaluators import build_evaluators, ClosedVocabularyEvaluator
+from rtfm.generation_utils import CachedGenerationModel, VLLMGenerationModel
 from rtfm.hf_utils import fetch_auth_token
 from rtfm.serialization.serializers import get_serializer
 from rtfm.task_config import get_tlm_config
@@ -40,7 +43,8 @@ from datasets import disable_caching
 logging.warning("disabling caching for hf datasets!")
 disable_caching()
 
-transformers.logging.set_verbosity_info()
+# Info-level transformers logging emits messages on every tokenizer/generate call.
+transformers.logging.set_verbosity_warning()
 
 
 def main(
@@ -54,6 +58,8 @@ def main(
     eval_task_file: Optional[str] = None,
     use_fast_kernels: bool = False,
     overwrite: bool = False,
+    cache_db: Optional[str] = None,
+    backend: str = "hf",
 ):
     if os.path.exists(outfile) and not overwrite:
         logging.warning(f"file {outfile} already exists; skipping evaluation.")
@@ -110,6 +116,7 @@ def main(
             f"this is expected if evaluating a base (not fine-tuned) model but unexpected otherwise."
         )
 
+    ckpt_dir = None
     if train_config.resume and not train_config.use_peft:
         ckpt_dir = get_latest_checkpoint(train_config.resume)
         model, _ = load_model_from_checkpoint(model, ckpt_dir)
@@ -129,6 +136,49 @@ def main(
         )
         print("#" * 50)
 
+    if backend == "vllm" and importlib.util.find_spec("vllm") is None:
+        logging.warning("vllm is not installed; falling back to the hf backend.")
+        backend = "hf"
+
+    if backend == "vllm":
+        assert (
+            not train_config.eval_closed_vocabulary
+        ), "closed-vocabulary evaluation is not supported with the vllm backend."
+        model = VLLMGenerationModel(
+            model, tokenizer, max_model_len=train_config.context_length
+        )
+
+    elif train_config.torch_compile:
+        # Compile forward() rather than wrapping the model, so that .generate() (which
+        # is not compiled) calls the compiled forward pass. Shapes vary across
+        # prompts and decoding steps, so compile with dynamic shapes.
+        logging.warning(
+            "compiling model forward pass with torch.compile(); the first forward "
+            "passes will be slow while the model is compiled."
+        )
+        # For PEFT models, .generate() calls the base model's forward pass.
+        base_model = (
+            model.get_base_model() if hasattr(model, "get_base_model") else model
+        )
+        base_model.forward = torch.compile(
+            base_model.forward,
+            fullgraph=train_config.torch_compile_fullgraph,
+            dynamic=True,
+        )
+
+    if cache_db:
+        model_id = ":".join(
+            x
+            for x in (
+                train_config.model_name,
+                ckpt_dir,
+                backend if backend != "hf" else None,
+            )
+            if x
+        )
+        logging.info(f"caching generations for model {model_id} in {cache_db}")
+        model = CachedGenerationModel(model, cache_db=cache_db, model_id=model_id)
+
     splits_to_keep = ("train", "validation", "test") if not eval_task_file else None
     print(f"splits_to_keep is {splits_to_keep}")
     eval_dataset_kwargs = prepare_eval_kwargs(
@@ -139,7 +189,9 @@ def main(
         train_config=train_config,
         splits_to_keep=splits_to_keep,
     )
-    eval_datasets_tokenized = prepare_eval_datasets(
+    # Datasets are loaded lazily; the next task's dataset is prepared while the
+    # current task is being evaluated.
+    eval_datasets_tokenized = iter_eval_datasets(
         eval_task_names=eval_task_names,
         exclude_task_names=None,
         data_arguments=data_arguments,
@@ -150,7 +202,7 @@ def main(
     evaluators = build_evaluators(train_config)
 
     output_metrics: Dict[str, float] = {}
-    for eval_task_name, eval_task_dataset in eval_datasets_tokenized.items():
+    for eval_task_name, eval_task_dataset in eval_datasets_tokenized:
         prefix = f"{split}/{eval_task_name}"
 
         for evaluator in evaluators:
@@ -177,7 +229,10 @@ def main(
             metrics = {f"{prefix}_{k}": v for k, v in metrics.items()}
             output_metrics.update(metrics)
             # TODO: log metrics to wandb.
-            print(metrics)
+            logger.info("metrics: %s", metrics)
+
+    if cache_db:
+        model.close()
 
     df = (
         pd.DataFrame.from_dict({k: [v] for k, v in output_metrics.items()})
@@ -208,6 +263,19 @@ if __name__ == "__main__":
 
     parser.add_argument("--eval-task-file", type=str, default=None)
     parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument(
+        "--cache-db",
+        default=None,
+        help="Optional path to a SQLite database used to cache model generations "
+        "across tasks and runs. Only valid with deterministic decoding.",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["hf", "vllm"],
+        default="hf",
+        help="Backend used for generation. If vllm is not installed, "
+        "falls back to hf.",
+    )
 
     parser.add_argument(
         "--split",
@@ -1,4 +1,6 @@
-from typing import List, Dict, Any, Sequence
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Sequence, Iterator, Tuple
 from typing import Union, Optional
 
 import datasets
@@ -78,6 +80,20 @@ def prepare_eval_kwargs(
     return eval_dataset_kwargs
 
 
+def _prepare_task_eval_dataset(
+    task_name: str,
+    data_arguments: DataArguments,
+    splits_to_keep: Sequence[str],
+    **kwargs,
+) -> Dataset:
+    tokenized_and_serialized = load_tokenize_and_serialize_tabular_dataset(
+        task_names=[task_name], data_arguments=data_arguments, **kwargs
+    )
+    return datasets.concatenate_datasets(
+        [tokenized_and_serialized[split] for split in splits_to_keep]
+    )
+
+
 def prepare_eval_datasets(
     eval_task_names: Union[str, None],
     exclude_task_names: Union[Sequence[str], None],
@@ -95,13 +111,9 @@ def prepare_eval_datasets(
         for task_name in eval_task_names:
             if task_name not in exclude_task_names:
                 k = task_name + "_" + dict_key_or_suffix
-                tokenized_and_serialized = load_tokenize_and_serialize_tabular_dataset(
-                    task_names=[task_name], data_arguments=data_arguments, **kwargs
-                )
-                ds = datasets.concatenate_datasets(
-                    [tokenized_and_serialized[split] for split in splits_to_keep]
+                eval_datasets_tokenized[k] = _prepare_task_eval_dataset(
+                    task_name, data_arguments, splits_to_keep, **kwargs
                 )
-                eval_datasets_tokenized[k] = ds
 
     elif eval_task_names and data_arguments.use_preserialized:
         # For preserialized data we have a single eval task with all shards.
@@ -128,6 +140,61 @@ def prepare_eval_datasets(
     return eval_datasets_tokenized
 
 
+def iter_eval_datasets(
+    eval_task_names: Union[str, None],
+    exclude_task_names: Union[Sequence[str], None],
+    data_arguments: DataArguments,
+    dict_key_or_suffix: str = "holdout",
+    splits_to_keep: Optional[Sequence[str]] = ("test",),
+    **kwargs,
+) -> Iterator[Tuple[str, Dataset]]:
+    """Yield the same (name, dataset) pairs as prepare_eval_datasets(), lazily.
+
+    For data that is not preserialized, the dataset for the next task is loaded in a
+    background thread while the caller evaluates the current one, so that CPU-bound
+    dataset preparation overlaps with inference."""
+    if not (eval_task_names and not data_arguments.use_preserialized):
+        yield from prepare_eval_datasets(
+            eval_task_names,
+            exclude_task_names,
+            data_arguments,
+            dict_key_or_suffix=dict_key_or_suffix,
+            splits_to_keep=splits_to_keep,
+            **kwargs,
+        ).items()
+        return
+
+    if exclude_task_names is None:
+        exclude_task_names = []
+    task_names = [x for x in eval_task_names if x not in exclude_task_names]
+    if not task_names:
+        return
+
+    if kwargs.get("tokenizer") is not None:
+        # The caller uses its tokenizer (i.e. for stopping criteria and decoding) while
+        # datasets are tokenized in the background thread. Fast tokenizers are not
+        # safe to use concurrently from multiple threads, so give the background
+        # thread its own copy.
+        kwargs = {**kwargs, "tokenizer": copy.deepcopy(kwargs["tokenizer"])}
+
+    def _submit(task_name):
+        return executor.submit(
+            _prepare_task_eval_dataset,
+            task_name,
+            data_arguments,
+            splits_to_keep,
+            **kwargs,
+        )
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = _submit(task_names[0])
+        for i, task_name in enumerate(task_names):
+            ds = future.result()
+            if i + 1 < len(task_names):
+                future = _submit(task_names[i + 1])
+            yield task_name + "_" + dict_key_or_suffix, ds
+
+
 def prepare_train_eval_datasets(
     train_task_names, train_eval_task_file, data_arguments: DataArguments, **kwargs
 ):
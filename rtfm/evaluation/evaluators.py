@@ -21,7 +21,7 @@ from tqdm import tqdm
 import rtfm.data
 from rtfm.configs import TrainConfig
 from rtfm.generation_utils import (
-    make_eoc_stopping_criterion,
+    generate_in_batches,
     prepare_input_ids_and_attention_mask_for_generation,
     parse_generated_text,
 )
@@ -29,6 +29,11 @@ from rtfm.special_tokens import EOC_TOKEN
 from rtfm.torch_utils import batch_to_xpu
 from rtfm.utils import timestamp
 
+# Minimum number of eval examples accumulated before generation. Identical inputs
+# are only generated once within this window, so it should not shrink along with
+# val_batch_size.
+MIN_PENDING_GENERATION_EXAMPLES = 256
+
 
 @dataclass
 class PostprocessedPredictions:
@@ -141,6 +146,42 @@ class OpenVocabularyEvaluator(Evaluator):
         oom_count = 0
         invalid_predictions = 0
 
+        def generate_and_postprocess(pending_examples):
+            """Run generation over a list of (input_ids, attention_mask, labels) examples."""
+            nonlocal invalid_predictions
+
+            generated_tokens = generate_in_batches(
+                model,
+                tokenizer,
+                [(x[0][0], x[1][0]) for x in pending_examples],
+                max_new_tokens=max_new_tokens,
+                max_batch_size=train_config.val_batch_size,
+            )
+            for (input_ids, _, labels), generated in zip(
+                pending_examples, generated_tokens
+            ):
+                postprocessed = postprocess(generated, labels)
+
+                all_preds.extend(postprocessed.decoded_preds)
+                all_labels.extend(postprocessed.decoded_labels)
+
+                invalid_predictions += postprocessed.invalid_predictions_count
+
+                if log_preds:  # accumulate predictions, labels, and inputs for logging.
+                    preds_for_logging["predictions"].append(postprocessed.decoded_preds)
+                    preds_for_logging["labels"].append(postprocessed.decoded_labels)
+                    preds_for_logging["input_text"].append(
+                        tokenizer.batch_decode(input_ids)
+                    )
+
+        # Examples are accumulated and passed to .generate() together, so that
+        # each call can batch together examples of similar length, and duplicate
+        # inputs within the pending examples are only generated once.
+        pending = []
+        max_pending = max(
+            train_config.val_batch_size * 4, MIN_PENDING_GENERATION_EXAMPLES
+        )
+
         start_time = timestamp()
         for batch in tqdm(
             loader, desc="eval_open_vocab", total=train_config.eval_max_samples
@@ -157,47 +198,34 @@ class OpenVocabularyEvaluator(Evaluator):
                     attention_mask,
                 ) = prepare_input_ids_and_attention_mask_for_generation(batch)
 
-                stopping_criterion = make_eoc_stopping_criterion(input_ids, tokenizer)
-
-                available_context_window_tokens = tokenizer.model_max_length - len(
-                    input_ids
+                available_context_window_tokens = (
+                    tokenizer.model_max_length - input_ids.shape[1]
                 )
                 if available_context_window_tokens < 2:
                     logging.warning(
-                        f"skipping call to .generate() with input of length {len(input_ids)}"
+                        f"skipping call to .generate() with input of length {input_ids.shape[1]}"
                     )
                     continue
 
-                generated_tokens = model.generate(
-                    input_ids,
-                    attention_mask=attention_mask,
-                    max_new_tokens=min(max_new_tokens, available_context_window_tokens),
-                    stopping_criteria=[stopping_criterion],
-                )
-
                 labels = batch["labels"]
 
                 assert labels.numel() > 0, "got empty labels tensor."
 
-                postprocessed = postprocess(generated_tokens, labels)
-
-                all_preds.extend(postprocessed.decoded_preds)
-                all_labels.extend(postprocessed.decoded_labels)
-
-                invalid_predictions += postprocessed.invalid_predictions_count
+                pending.append((input_ids, attention_mask, labels))
 
-                if log_preds:  # accumulate predictions, labels, and inputs for logging.
-                    preds_for_logging["predictions"].append(postprocessed.decoded_preds)
-                    preds_for_logging["labels"].append(postprocessed.decoded_labels)
-                    preds_for_logging["input_text"].append(
-                        tokenizer.batch_decode(input_ids)
-                    )
+                if len(pending) >= max_pending:
+                    generate_and_postprocess(pending)
+                    pending = []
 
             local_samples_seen += len(input_ids)
 
-            if len(all_preds) >= train_config.eval_max_samples:
+            if len(all_preds) + len(pending) >= train_config.eval_max_samples:
                 break
 
+        if pending:
+            with torch.no_grad():
+                generate_and_postprocess(pending)
+
         runtime = timestamp() - start_time
 
         results = {
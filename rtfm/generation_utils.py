@@ -1,6 +1,10 @@
+import hashlib
 import logging
-from typing import Dict, Tuple
+import sqlite3
+import tempfile
+from typing import Dict, List, Optional, Sequence, Tuple
 
+import numpy as np
 import torch
 import transformers
 
@@ -22,20 +26,26 @@ class KeywordsStoppingCriteria(transformers.StoppingCriteria):
 
     def __call__(
         self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
-    ) -> bool:
+    ) -> torch.BoolTensor:
+        """Return a boolean tensor of shape [batch_size] indicating which sequences are done."""
         if self.start_len is None:
             self.start_len = self.input_ids.shape[1]
 
+        is_done = torch.zeros(
+            len(output_ids), dtype=torch.bool, device=output_ids.device
+        )
         for keyword_id in self.keyword_ids:
-            if output_ids[0, -1] == keyword_id:
-                return True
+            is_done |= output_ids[:, -1] == keyword_id
+        if is_done.all():
+            return is_done
+
         outputs = self.tokenizer.batch_decode(
             output_ids[:, self.start_len :], skip_special_tokens=True
-        )[0]
-        for keyword in self.keywords:
-            if keyword in outputs:
-                return True
-        return False
+        )
+        for i, output in enumerate(outputs):
+            if not is_done[i] and any(keyword in output for keyword in self.keywords):
+                is_done[i] = True
+        return is_done
 
 
 def make_eoc_stopping_criterion(input_ids, tokenizer):
@@ -46,6 +56,125 @@ def make_eoc_stopping_criterion(input_ids, tokenizer):
     )
 
 
+def generate_in_batches(
+    model,
+    tokenizer,
+    inputs: Sequence[Tuple[torch.Tensor, torch.Tensor]],
+    max_new_tokens: int,
+    max_batch_size: int,
+) -> List[torch.Tensor]:
+    """Call .generate() on inputs in batches of up to max_batch_size.
+
+    inputs is a sequence of (input_ids, attention_mask) tuples, each of shape [seq_len].
+    Inputs are sorted by length and left-padded so that each batch contains
+    similarly-sized sequences. Returns, in the same order as inputs, a tensor of shape
+    [1, output_len] for each input, containing the input ids followed by the
+    generated tokens up to (and including) the first stop token; this matches the
+    output of .generate() on the unpadded input alone.
+
+    Identical inputs (i.e. rows with the same serialization and shots) are only
+    passed to .generate() once.
+
+    If model is a CachedGenerationModel, each (unpadded) input is looked up in the
+    cache individually, and only the cache misses are passed to .generate().
+    """
+    cache = None
+    if isinstance(model, CachedGenerationModel):
+        cache = model
+        model = cache.model
+
+    unique_idxs: Dict[Tuple[bytes, bytes], int] = {}
+    inverse = []
+    for input_ids, attention_mask in inputs:
+        key = (
+            input_ids.cpu().numpy().tobytes(),
+            attention_mask.cpu().numpy().tobytes(),
+        )
+        inverse.append(unique_idxs.setdefault(key, len(unique_idxs)))
+    if len(unique_idxs) < len(inputs):
+        unique_inputs = [None] * len(unique_idxs)
+        for x, i in zip(inputs, inverse):
+            unique_inputs[i] = x
+        unique_outputs = generate_in_batches(
+            cache if cache is not None else model,
+            tokenizer,
+            unique_inputs,
+            max_new_tokens,
+            max_batch_size,
+        )
+        return [unique_outputs[i] for i in inverse]
+
+    def _max_new_tokens_for_input(i) -> int:
+        return min(max_new_tokens, tokenizer.model_max_length - len(inputs[i][0]))
+
+    outputs: List[Optional[torch.Tensor]] = [None] * len(inputs)
+    to_generate = []
+    for i, (input_ids, attention_mask) in enumerate(inputs):
+        cached = (
+            cache.get(input_ids, attention_mask, _max_new_tokens_for_input(i))
+            if cache is not None
+            else None
+        )
+        if cached is not None:
+            outputs[i] = cached.to(input_ids.device)
+        else:
+            to_generate.append(i)
+
+    order = sorted(to_generate, key=lambda i: len(inputs[i][0]))
+    for start in range(0, len(order), max_batch_size):
+        batch_idxs = order[start : start + max_batch_size]
+        max_len = max(len(inputs[i][0]) for i in batch_idxs)
+        input_ids, _ = inputs[batch_idxs[0]]
+        batch_input_ids = torch.full(
+            (len(batch_idxs), max_len),
+            tokenizer.pad_token_id,
+            dtype=input_ids.dtype,
+            device=input_ids.device,
+        )
+        batch_attention_mask = torch.zeros(
+            (len(batch_idxs), max_len), dtype=torch.long, device=input_ids.device
+        )
+        for row, i in enumerate(batch_idxs):
+            input_ids, attention_mask = inputs[i]
+            batch_input_ids[row, max_len - len(input_ids) :] = input_ids
+            batch_attention_mask[row, max_len - len(input_ids) :] = attention_mask
+
+        stopping_criterion = make_eoc_stopping_criterion(batch_input_ids, tokenizer)
+        batch_max_new_tokens = min(max_new_tokens, tokenizer.model_max_length - max_len)
+        generated_tokens = model.generate(
+            batch_input_ids,
+            attention_mask=batch_attention_mask,
+            max_new_tokens=batch_max_new_tokens,
+            stopping_criteria=[stopping_criterion],
+        )
+
+        # Sequences that finish early are padded until the whole batch is done;
+        # drop everything after the first stop token.
+        stop_token_ids = torch.tensor(
+            stopping_criterion.keyword_ids + [tokenizer.eos_token_id],
+            device=generated_tokens.device,
+        )
+        for row, i in enumerate(batch_idxs):
+            completion = generated_tokens[row, max_len:]
+            stop_positions = torch.isin(completion, stop_token_ids).nonzero()
+            if len(stop_positions):
+                completion = completion[: stop_positions[0].item() + 1]
+            outputs[i] = torch.cat((inputs[i][0], completion))[None, :]
+            # Only cache outputs that do not depend on the other inputs in the batch,
+            # i.e. that were not cut short by a longer input in the same batch.
+            if cache is not None and (
+                len(stop_positions)
+                or batch_max_new_tokens == _max_new_tokens_for_input(i)
+            ):
+                cache.put(
+                    inputs[i][0],
+                    inputs[i][1],
+                    _max_new_tokens_for_input(i),
+                    outputs[i],
+                )
+    return outputs
+
+
 def prepare_input_ids_and_attention_mask_for_generation(
     batch: Dict[str, torch.Tensor]
 ) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -87,3 +216,206 @@ def parse_generated_text(text: str) -> Tuple[str, bool]:
     if not parsed_completion:
         logging.warning(f"got empty completion after parsing from text {text}")
     return parsed_completion.strip(), True
+
+
+class CachedGenerationModel:
+    """Wraps a model so that generations are cached in a SQLite database.
+
+    Entries are keyed by a hash of model_id, the input ids and attention mask,
+    and the (non-callable) generation kwargs; stopping criteria are not part of
+    the key. Only use this with deterministic (i.e. greedy) decoding.
+
+    generate_in_batches() caches each unpadded input separately via get() and put(),
+    so that entries are reused regardless of the batch an input appears in. Direct
+    calls to .generate() cache the whole call.
+
+    All other attributes are forwarded to the wrapped model.
+    """
+
+    def __init__(self, model, cache_db: str, model_id: str, commit_every: int = 64):
+        self.model = model
+        self.model_id = model_id
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(cache_db)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, shape TEXT, output BLOB)"
+        )
+
+    def __getattr__(self, name):
+        if name == "model":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def _make_key(self, input_ids: torch.Tensor, **kwargs) -> str:
+        h = hashlib.sha256()
+        h.update(self.model_id.encode("utf-8"))
+        h.update(input_ids.cpu().numpy().astype(np.int64).tobytes())
+        h.update(str(tuple(input_ids.shape)).encode("utf-8"))
+        attention_mask = kwargs.pop("attention_mask", None)
+        if attention_mask is not None:
+            h.update(attention_mask.cpu().numpy().astype(np.int64).tobytes())
+        kwargs.pop("stopping_criteria", None)
+        h.update(repr(sorted(kwargs.items())).encode("utf-8"))
+        return h.hexdigest()
+
+    def _lookup(self, key: str) -> Optional[torch.Tensor]:
+        row = self.conn.execute(
+            "SELECT shape, output FROM cache WHERE key=?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        shape = tuple(int(x) for x in row[0].split(","))
+        output = np.frombuffer(row[1], dtype=np.int64).reshape(shape)
+        return torch.from_numpy(output.copy())
+
+    def _store(self, key: str, output: torch.Tensor):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+            (
+                key,
+                ",".join(str(x) for x in output.shape),
+                output.cpu().numpy().astype(np.int64).tobytes(),
+            ),
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def get(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor, max_new_tokens: int
+    ) -> Optional[torch.Tensor]:
+        """Return the cached (CPU) output for a single unpadded input, if any."""
+        return self._lookup(
+            self._make_key(
+                input_ids, attention_mask=attention_mask, max_new_tokens=max_new_tokens
+            )
+        )
+
+    def put(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        max_new_tokens: int,
+        output: torch.Tensor,
+    ):
+        """Cache the output for a single unpadded input."""
+        self._store(
+            self._make_key(
+                input_ids, attention_mask=attention_mask, max_new_tokens=max_new_tokens
+            ),
+            output,
+        )
+
+    def generate(self, input_ids: torch.Tensor, **kwargs) -> torch.Tensor:
+        key = self._make_key(input_ids, **kwargs)
+        output = self._lookup(key)
+        if output is not None:
+            return output.to(input_ids.device)
+
+        output = self.model.generate(input_ids, **kwargs)
+        self._store(key, output)
+        return output
+
+    def commit(self):
+        self.conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        logging.info(
+            f"generation cache: {self.hits} hits, {self.misses} misses for {self.model_id}"
+        )
+        self.conn.close()
+
+
+class VLLMGenerationModel:
+    """Generates with vLLM, using the same .generate() interface as a HF model.
+
+    The model (with any PEFT adapters merged) and tokenizer are saved to a temporary
+    directory and loaded into vLLM; the HF model is then moved to the CPU. Decoding
+    is greedy, and stopping criteria are replaced by stopping on EOC_TOKEN or EOS.
+    """
+
+    def __init__(self, model, tokenizer, **llm_kwargs):
+        import vllm
+
+        self._vllm = vllm
+        self.tokenizer = tokenizer
+
+        if hasattr(model, "merge_and_unload"):
+            model = model.merge_and_unload()
+        self._tmpdir = tempfile.TemporaryDirectory()
+        logging.info(f"saving model for vllm to {self._tmpdir.name}")
+        model.save_pretrained(self._tmpdir.name)
+        tokenizer.save_pretrained(self._tmpdir.name)
+        model.to("cpu")
+        torch.cuda.empty_cache()
+
+        self.llm = vllm.LLM(model=self._tmpdir.name, **llm_kwargs)
+
+        eoc_token_ids = tokenizer(EOC_TOKEN, add_special_tokens=False).input_ids
+        self.stop_token_ids = eoc_token_ids if len(eoc_token_ids) == 1 else []
+
+    def eval(self):
+        return self
+
+    def generate(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        max_new_tokens: int = 128,
+        **kwargs,
+    ) -> torch.Tensor:
+        """Return the (left-padded) input ids followed by the generated tokens.
+
+        Rows are right-padded with the tokenizer's pad token. The output is on the
+        same device as input_ids.
+        """
+        del kwargs  # stopping_criteria are handled by vllm's stop conditions.
+        device = input_ids.device
+        input_ids = input_ids.cpu()
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        # Strip left-padding from each row.
+        num_pad_tokens = (attention_mask.cpu().cumsum(dim=1) == 0).sum(dim=1)
+        prompts = [
+            {"prompt_token_ids": row[n:].tolist()}
+            for row, n in zip(input_ids, num_pad_tokens.tolist())
+        ]
+        sampling_params = self._vllm.SamplingParams(
+            temperature=0.0,
+            max_tokens=max_new_tokens,
+            stop=[EOC_TOKEN],
+            stop_token_ids=self.stop_token_ids,
+            include_stop_str_in_output=True,
+            skip_special_tokens=False,
+        )
+        outputs = self.llm.generate(prompts, sampling_params, use_tqdm=False)
+
+        completions = []
+        for output in outputs:
+            completion = list(output.outputs[0].token_ids)
+            stop_reason = output.outputs[0].stop_reason
+            if isinstance(stop_reason, int) and completion[-1:] != [stop_reason]:
+                completion.append(stop_reason)
+            completions.append(completion)
+
+        prompt_len = input_ids.shape[1]
+        result = torch.full(
+            (len(input_ids), prompt_len + max(len(x) for x in completions)),
+            self.tokenizer.pad_token_id,
+            dtype=input_ids.dtype,
+        )
+        result[:, :prompt_len] = input_ids
+        for i, completion in enumerate(completions):
+            result[i, prompt_len : prompt_len + len(completion)] = torch.tensor(
+                completion, dtype=input_ids.dtype
+            )
+        return result.to(device)
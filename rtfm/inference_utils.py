@@ -1,10 +1,13 @@
+import hashlib
 import json
 import logging
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import List, Optional, Literal, Any
+from typing import List, Optional, Literal, Any, Tuple
 
 import numpy as np
 import pandas as pd
+import torch
 import transformers
 from datasets.utils.logging import (
     disable_progress_bar,
@@ -17,7 +20,7 @@ from rtfm.arguments import DataArguments
 from rtfm.data import (
     serialize_dataset_fn,
     add_qa_and_eoc_tokens_to_example,
-    tokenize_ds_dict,
+    tokenize_ds,
     build_formatted_df,
     prepare_hf_dataset_from_formatted_df,
     make_few_shot_sample,
@@ -42,6 +45,78 @@ def prepare_dataframe(
     return prepare_hf_dataset_from_formatted_df(df, as_iterable=as_iterable)
 
 
+# Tokenized shots, keyed by a hash of the labeled examples and everything else
+# that affects their serialization; see _shots_cache_key().
+_SHOTS_CACHE: "OrderedDict[str, List[Tuple[torch.Tensor, torch.Tensor]]]" = (
+    OrderedDict()
+)
+_SHOTS_CACHE_MAX_ENTRIES = 8
+
+
+def _shots_cache_key(
+    labeled_examples: pd.DataFrame,
+    target_colname: str,
+    tokenizer,
+    serializer: RowSerializer,
+    cfg: TLMConfig,
+) -> Optional[str]:
+    """Return a key identifying the tokenized shots, or None if they cannot be cached."""
+    if serializer.config.shuffle_instance_features or serializer.config.feature_dropout:
+        # Serialization is random, so shots must be re-serialized on every call.
+        return None
+    try:
+        df_hash = pd.util.hash_pandas_object(labeled_examples, index=True)
+    except TypeError:
+        # Case: unhashable values (i.e. lists) in labeled_examples.
+        return None
+    h = hashlib.blake2b(df_hash.values.tobytes())
+    h.update(
+        repr(
+            (
+                list(labeled_examples.columns),
+                # hash_pandas_object() does not distinguish i.e. bool from int values,
+                # which are serialized differently.
+                tuple(map(str, labeled_examples.dtypes)),
+                target_colname,
+                tokenizer.name_or_path,
+                len(tokenizer),
+                tokenizer.model_max_length,
+                type(serializer).__name__,
+                serializer.config,
+                cfg,
+            )
+        ).encode("utf-8")
+    )
+    return h.hexdigest()
+
+
+def _serialize_and_tokenize_examples(
+    df: pd.DataFrame,
+    target_colname: str,
+    data_arguments: DataArguments,
+    tokenizer,
+    serializer: RowSerializer,
+    cfg: TLMConfig,
+) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Serialize and tokenize the rows of df, returning (input_ids, labels) tuples.
+
+    This follows the same procedure used for training + evaluation."""
+    ds = prepare_dataframe(df, target_colname, data_arguments)
+    ds = serialize_dataset_fn(
+        ds, data_args=data_arguments, serializer=serializer, cfg=cfg
+    )
+    ds = ds.map(add_qa_and_eoc_tokens_to_example)
+    # At this point, the dataset has the same format as the output of
+    # rtfm.data.load_serialized_dataset().
+    ds = tokenize_ds(ds, tokenizer=tokenizer, data_arguments=data_arguments)
+    # We call list() even when there is one element in order to actually trigger
+    # the lazy-loading of the data.
+    examples = list(
+        ds.select_columns(["input_ids", "labels"]).with_format("torch").take(len(df))
+    )
+    return [(x["input_ids"], x["labels"]) for x in examples]
+
+
 def infer_on_example(
     model: transformers.AutoModelForCausalLM,
     tokenizer,
@@ -117,58 +192,35 @@ def infer_on_example(
             label_values=target_choices,
         )
 
-    # Build datasets from the examples, to follow the same procedure
-    # used for training + evaluation.
-    if is_fewshot:
-        ds_dict = {
-            "train": prepare_dataframe(
-                labeled_examples, target_colname, data_arguments
-            ),
-            "test": prepare_dataframe(target_example, target_colname, data_arguments),
-        }
-    else:
-        ds_dict = {
-            "test": prepare_dataframe(target_example, target_colname, data_arguments),
-        }
-
-    ds_dict = {
-        split: serialize_dataset_fn(
-            ds, data_args=data_arguments, serializer=serializer, cfg=cfg
-        )
-        for split, ds in ds_dict.items()
-    }
-    ds_dict = {
-        split: ds.map(add_qa_and_eoc_tokens_to_example) for split, ds in ds_dict.items()
-    }
-    # At this point, the datasets have the same format as the output of
-    # rtfm.data.load_serialized_dataset().
-
-    tokenized_ds_dict = tokenize_ds_dict(
-        ds_dict, tokenizer=tokenizer, data_arguments=data_arguments
-    )
-
-    # Shots is a list of dictionaries
+    # Shots are a list of (input_ids, labels) tuples. When the same labeled examples
+    # are used for many predictions, they are only serialized and tokenized once.
     if is_fewshot:
-        ds_train = tokenized_ds_dict["train"]
-        shots = list(
-            ds_train.select_columns(["input_ids", "labels"])
-            .with_format("torch")
-            .take(len(labeled_examples))
+        shots_key = _shots_cache_key(
+            labeled_examples, target_colname, tokenizer, serializer, cfg
         )
-        # Make shots a list of tuples
-        shots = [(x["input_ids"], x["labels"]) for x in shots]
+        shots = _SHOTS_CACHE.get(shots_key) if shots_key is not None else None
+        if shots is None:
+            shots = _serialize_and_tokenize_examples(
+                labeled_examples,
+                target_colname,
+                data_arguments,
+                tokenizer,
+                serializer,
+                cfg,
+            )
+            if shots_key is not None:
+                _SHOTS_CACHE[shots_key] = shots
+                if len(_SHOTS_CACHE) > _SHOTS_CACHE_MAX_ENTRIES:
+                    _SHOTS_CACHE.popitem(last=False)
+        else:
+            _SHOTS_CACHE.move_to_end(shots_key)
     else:
         shots = None
 
-    # For the target_sample, we still call list() even though it is one
-    # element in order to actually trigger the lazy-loading of the data.
-    ds_test = tokenized_ds_dict["test"]
-    target_sample = list(
-        ds_test.select_columns(["input_ids", "labels"]).with_format("torch").take(1)
+    target_sample = _serialize_and_tokenize_examples(
+        target_example, target_colname, data_arguments, tokenizer, serializer, cfg
     )[0]
 
-    target_sample = (target_sample["input_ids"], target_sample["labels"])
-
     enable_progress_bar()
 
     # Make the few-shot example.
@@ -81,7 +81,7 @@ class PipelineConfig:
     max_tables: Optional[int] = None
     train_frac: float = 0.975
     split_random_seed = 42
-    output_shard_factor: int = 1000
+    output_shard_factor: int = 50
     output_file_prefix: Optional[str] = None
     chunk_size: int = 64
     target_shard_size_mb: int = 500
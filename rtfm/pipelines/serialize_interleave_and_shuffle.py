@@ -12,17 +12,23 @@ python -m rtfm.pipelines.serialize_interleave_and_shuffle \
     --chunk_size 256 \
     --max_tables 100_000
 """
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import dataclasses
+from functools import lru_cache, partial
 import glob
-import json
 import logging
-from multiprocessing import Pool
 import os
+import queue
 import random
+import threading
 import time
-from typing import Sequence
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
 
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import ray
 from sklearn.model_selection import train_test_split
 from transformers import HfArgumentParser
@@ -40,50 +46,83 @@ from rtfm.pipelines.pipeline_utils import Resharder, PipelineConfig
 from rtfm.serialization.serializers import get_serializer
 
 
-def process_file(
-    row,
-    data_args: DataArguments,
-    serializer_config: SerializerConfig,
-    model_max_len_tokens=4096,
-    appx_chars_per_token=3.5,
-):
-    filename = row["item"]
-    logging.warning(f"loading {filename}")
+@lru_cache(maxsize=4)
+def _cached_serializer(serializer_config_key: tuple):
+    """Build a serializer once per worker process for a given SerializerConfig."""
+    return get_serializer(SerializerConfig(*serializer_config_key))
 
-    try:
-        df = build_formatted_df_from_file(
-            filename,
+
+class ProcessFile:
+    """Ray Data UDF that serializes every record of the tables in a batch of files.
+
+    The serializer and map function are built once per actor, rather than once per
+    file, and each file's serialized records are emitted as a single DataFrame.
+    """
+
+    def __init__(
+        self,
+        data_args: DataArguments,
+        serializer_config: SerializerConfig,
+        model_max_len_tokens=4096,
+        appx_chars_per_token=3.5,
+    ):
+        self.data_args = data_args
+        self.max_chars = int(model_max_len_tokens * appx_chars_per_token)
+        self.serializer = _cached_serializer(dataclasses.astuple(serializer_config))
+        self._map_fn = partial(
+            example_map_fn,
             data_args=data_args,
+            serializer=self.serializer,
+            cfg=None,
+        )
+
+    def process_file(self, filename: str) -> Optional[pd.DataFrame]:
+        logging.warning(f"loading {filename}")
+
+        try:
+            table = build_formatted_df_from_file(
+                filename, data_args=self.data_args, as_arrow=True
+            )
+        except NoTargetCandidatesError:
+            return None
+        except ValueError as ve:
+            logging.error(ve)
+            return None
+        except TypeError as te:
+            logging.error(te)
+            return None
+
+        # Records are materialized as dicts one batch at a time.
+        records = (
+            record
+            for batch in table.to_batches(max_chunksize=1024)
+            for record in batch.to_pylist()
         )
-    except NoTargetCandidatesError:
-        return {"item": "Failed"}
-    except ValueError as ve:
-        logging.error(ve)
-        return {"item": "Failed"}
-    except TypeError as te:
-        logging.error(te)
-        return {"item": "Failed"}
-
-    records = df.to_dict(orient="records")
-
-    serializer = get_serializer(serializer_config)
-    _map_fn = partial(
-        example_map_fn,
-        data_args=data_args,
-        serializer=serializer,
-        cfg=None,
-    )
 
-    for record in records:
-        mapped = _map_fn(record)
-        # Do not keep examples that would not fit in the model's context
-        if len(mapped["text"]) > int(model_max_len_tokens * appx_chars_per_token):
+        outputs = []
+        num_dropped = 0
+        for record in records:
+            mapped = self._map_fn(record)
+            # Do not keep examples that would not fit in the model's context
+            if len(mapped["text"]) > self.max_chars:
+                num_dropped += 1
+                continue
+            # after applying map_fn, each element has fields: 'text', 'class_label_as_text'
+            outputs.append({**mapped, "filename": filename})
+        if num_dropped:
             logging.warning(
-                f"dropping too-long sample with text len {len(mapped['text'])}"
+                f"dropped {num_dropped} too-long samples (max {self.max_chars} chars) "
+                f"from {filename}"
             )
-            continue
-        # after applying map_fn, each element has fields: 'text', 'class_label_as_text'
-        yield {**mapped, "filename": filename}
+        return pd.DataFrame(
+            outputs, columns=["text", "class_label_as_text", "filename"]
+        )
+
+    def __call__(self, batch: pd.DataFrame) -> Iterator[pd.DataFrame]:
+        for filename in batch["item"]:
+            output = self.process_file(filename)
+            if output is not None and len(output):
+                yield output
 
 
 def chunked(iterable, n):
@@ -92,6 +131,62 @@ def chunked(iterable, n):
         yield iterable[i : i + n]
 
 
+def _iter_record_batches(
+    parquet_files: Sequence[str], batch_size: int
+) -> Iterator[Tuple[str, Optional[pa.RecordBatch]]]:
+    """Yield (parquet_file, batch) for each record batch in parquet_files.
+
+    After the last batch of each file, (parquet_file, None) is yielded.
+    """
+    for parquet_file in parquet_files:
+        # Stream the parquet file in record batches instead of loading it fully
+        for batch in pq.ParquetFile(parquet_file).iter_batches(batch_size=batch_size):
+            yield parquet_file, batch
+        yield parquet_file, None
+
+
+def _prefetch(iterable: Iterable, max_prefetch: int = 3) -> Iterator:
+    """Iterate over iterable in a background thread, buffering up to max_prefetch items.
+
+    Exceptions raised in the background thread are re-raised by the caller.
+    """
+    q = queue.Queue(maxsize=max_prefetch)
+    done = object()
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                _put((item, None))
+        except Exception as e:
+            _put((None, e))
+        _put((done, None))
+
+    thread = threading.Thread(target=_produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, exc = q.get()
+            if exc is not None:
+                raise exc
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
 def convert_to_wds(
     parquet_files: Sequence[str],
     index: int,
@@ -99,7 +194,10 @@ def convert_to_wds(
     prefix: str,
     split: str,
     eval_split=0.01,
+    read_batch_size=4096,
+    rows_per_sample=64,
 ):
+    """Write parquet_files to a worker-local tar shard."""
     do_eval_split = split == "train" and random.uniform(0.0, 1.0) < eval_split
 
     base_file_name = "-".join([x for x in (prefix, split, f"{index:06d}.tar") if x])
@@ -112,43 +210,50 @@ def convert_to_wds(
         os.makedirs(os.path.dirname(wds_eval_filename), exist_ok=True)
         eval_sink = wds.TarWriter(wds_eval_filename) if do_eval_split else None
 
-    # Open a WebDataset writer
-    def encode_row(ser: pd.Series):
-        return json.dumps(ser.to_dict(), ensure_ascii=False).encode("utf-8")
-
-    for parquet_file in parquet_files:
-        # Read the parquet file
-        df = pd.read_parquet(parquet_file)
+    # Rows are packed rows_per_sample at a time into a single JSONL tar entry.
+    buffers = {"train": [], "eval": []}
+
+    def _flush(buf_name: str, base_filename: str):
+        buf = buffers[buf_name]
+        if not buf:
+            return
+        key = f"{base_filename}__{buf[0][0]}-{buf[-1][0]}"
+        sample = {"__key__": key, "jsonl": b"\n".join(p for _, p in buf)}
+        (eval_sink if buf_name == "eval" else sink).write(sample)
+        buf.clear()
+
+    # Randomly split rows into train and eval if this is train_eval split
+    rng = np.random.default_rng(42)
+    row_offset = 0
+    # Parquet reads happen in a background thread, overlapping with encoding + writing.
+    for parquet_file, batch in _prefetch(
+        _iter_record_batches(parquet_files, read_batch_size)
+    ):
         # Extract filename without extension for use in webdataset keys
         base_filename = os.path.splitext(os.path.basename(parquet_file))[0]
 
-        # Randomly split the DataFrame into train and eval if this is train_eval split
+        if batch is None:
+            # Case: reached the end of parquet_file.
+            _flush("train", base_filename)
+            _flush("eval", base_filename)
+            os.remove(parquet_file)
+            rng = np.random.default_rng(42)
+            row_offset = 0
+            continue
+
+        rows = batch.to_pylist()
         if do_eval_split:
-            # Try/Except to handle small dataframes that cannot be split
-            try:
-                train_df, eval_df = train_test_split(
-                    df, test_size=eval_split, random_state=42
-                )
-            except ValueError:
-                logging.warning(f"Skipping train_eval split of df with size {len(df)}")
-                train_df = df
-                eval_df = None
+            is_eval = rng.random(len(rows)) < eval_split
         else:
-            train_df = df
-            eval_df = None
-
-        # Process the training data
-        for index, row in train_df.iterrows():
-            key = f"{base_filename}__{index}"
-            sink.write({"__key__": key, "json": encode_row(row)})
+            is_eval = np.zeros(len(rows), dtype=bool)
 
-        # Process the evaluation data if applicable
-        if do_eval_split and (eval_df is not None):
-            for index, row in eval_df.iterrows():
-                key = f"{base_filename}__{index}"
-                eval_sink.write({"__key__": key, "json": encode_row(row)})
-
-        os.remove(parquet_file)
+        for i, (row, row_is_eval) in enumerate(zip(rows, is_eval)):
+            buf_name = "eval" if row_is_eval else "train"
+            payload = orjson.dumps(row, option=orjson.OPT_SERIALIZE_NUMPY)
+            buffers[buf_name].append((row_offset + i, payload))
+            if len(buffers[buf_name]) >= rows_per_sample:
+                _flush(buf_name, base_filename)
+        row_offset += len(rows)
 
     # Close the WebDataset writers
     sink.close()
@@ -156,6 +261,19 @@ def convert_to_wds(
         eval_sink.close()
 
 
+# Per-process arguments shared by every convert_to_wds call in a worker.
+_worker_state = {}
+
+
+def _init_worker(output_dir: str, prefix: str, split: str):
+    _worker_state.update(output_dir=output_dir, prefix=prefix, split=split)
+
+
+def _convert_chunk(index_and_chunk):
+    index, file_chunk = index_and_chunk
+    convert_to_wds(file_chunk, index, **_worker_state)
+
+
 def parquet_to_wds(
     parquet_files,
     prefix: str,
@@ -170,22 +288,21 @@ def parquet_to_wds(
     # Chunk the files
     file_chunks = list(chunked(parquet_files, chunk_size))
 
-    # Create a pool of workers
-    with Pool(os.cpu_count()) as pool:
-        # Map parquet files to the converter function with the specified output directory
-        list(
-            tqdm(
-                pool.starmap(
-                    convert_to_wds,
-                    [
-                        (file_chunk, i, output_dir, prefix, split)
-                        for i, file_chunk in enumerate(file_chunks)
-                    ],
-                ),
-                total=len(parquet_files) // chunk_size,
-                desc=f"{prefix} parquet to wds",
-            )
-        )
+    # Create a pool of workers. The static arguments are set once per worker by the
+    # initializer; each worker writes its own shard(s) without any shared state, and
+    # only the file chunk crosses process boundaries. The written shards are picked
+    # up from output_dir by the resharder.
+    with ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        initializer=_init_worker,
+        initargs=(output_dir, prefix, split),
+    ) as executor:
+        for _ in tqdm(
+            executor.map(_convert_chunk, enumerate(file_chunks)),
+            total=len(file_chunks),
+            desc=f"{prefix} parquet to wds",
+        ):
+            pass
 
     # reshard the outputs
     resharder = Resharder(target_shard_size_mb)
@@ -241,14 +358,22 @@ def main(
     # and also to control the size of the output files (this keeps output files small, which helps
     # us shuffle them later).
 
-    fn_kwargs = {
+    fn_constructor_kwargs = {
         "data_args": data_args,
         "serializer_config": serializer_config,
     }
-    test_ds = test_ds.flat_map(process_file, fn_kwargs=fn_kwargs).repartition(
+    # Use one file per batch so that memory usage matches processing the files
+    # individually; the serializer is still only constructed once per actor.
+    map_batches_kwargs = dict(
+        fn_constructor_kwargs=fn_constructor_kwargs,
+        batch_size=1,
+        batch_format="pandas",
+        concurrency=parallelism,
+    )
+    test_ds = test_ds.map_batches(ProcessFile, **map_batches_kwargs).repartition(
         parallelism * pipeline_config.output_shard_factor
     )
-    train_ds = train_ds.flat_map(process_file, fn_kwargs=fn_kwargs).repartition(
+    train_ds = train_ds.map_batches(ProcessFile, **map_batches_kwargs).repartition(
         parallelism * pipeline_config.output_shard_factor
     )
 
@@ -256,7 +381,12 @@ def main(
 
     for ds, split in zip((train_ds, test_ds), splits):
         ds.write_parquet(
-            f"local://{os.path.abspath(pipeline_config.output_dir)}/{split}"
+            f"local://{os.path.abspath(pipeline_config.output_dir)}/{split}",
+            arrow_parquet_args_fn=lambda: {
+                "compression": "zstd",
+                "compression_level": 3,
+                "row_group_size": 65536,
+            },
         )
 
     ray.shutdown()
@@ -2,6 +2,7 @@ import json
 import re
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import List, Dict, Union, Any, Optional, Sequence
 
 import numpy as np
@@ -24,6 +25,12 @@ _SPECIAL_TOKENS_MAP = {
 }
 
 
+@lru_cache(maxsize=None)
+def _is_number_type(t: type) -> bool:
+    """Cached np.issubdtype(t, np.number); this is called for every serialized value."""
+    return np.issubdtype(t, np.number)
+
+
 def basic_serialize_choices(choices: List[str]) -> str:
     if not choices:
         return ""
@@ -40,13 +47,13 @@ def v2_serialize_choices(
     if not choices:
         return ""
     else:
-        output = ""
+        parts = []
         if add_sep_before:
-            output += sep_tok
-        output += sep_tok.join(choices)
+            parts.append(sep_tok)
+        parts.append(sep_tok.join(choices))
         if add_sep_after:
-            output += sep_tok
-        return output
+            parts.append(sep_tok)
+        return "".join(parts)
 
 
 @dataclass
@@ -63,14 +70,14 @@ class RowSerializer(ABC):
 
     def _round_to_max_precision(self, val: Any):
         """Optionally round a feature to a maximum number of decimal places."""
-        assert np.issubdtype(type(val), np.number)
+        assert _is_number_type(type(val))
         if self.config.max_precision is not None:
             return round(val, self.config.max_precision)
         else:
             return val
 
     def _preprocess_value(self, val: Any):
-        if np.issubdtype(type(val), np.number):
+        if _is_number_type(type(val)):
             val = self._round_to_max_precision(val)
         elif isinstance(val, str):
             val = str(val).strip()
@@ -82,10 +89,13 @@ class RowSerializer(ABC):
         """Check an example to ensure it conforms to expected restrictions."""
         if isinstance(x, pd.Series):
             x = x.to_dict()
-        keys = list(x.keys())
-        for i, key in enumerate(keys[:-1]):
-            if self.strict and any(key in x for x in keys[i + 1 :]):
-                raise ValueError(f"Cannot have one key that contains another: {keys}")
+        if self.strict:
+            keys = list(x.keys())
+            for i, key in enumerate(keys[:-1]):
+                if any(key in x for x in keys[i + 1 :]):
+                    raise ValueError(
+                        f"Cannot have one key that contains another: {keys}"
+                    )
         if "__metafeatures__" in x:
             # Check that every feature entry for each metafeature_corresponds to an actual feature.
             for metafeature_dict in x["__metafeatures__"].values():
@@ -174,19 +184,18 @@ class BasicSerializer(RowSerializer):
 
     def serialize_key_and_value(self, k, v, meta: Dict[str, Any]) -> str:
         """Serialize an individual key-value pair."""
-        serialized = f"{self.serialize_key(k)} {self._preprocess_value(v)}"
+        parts = [f"{self.serialize_key(k)} {self._preprocess_value(v)}"]
         if meta:
             # Note that metafeatures will only be present for some features. This is because
             # most metafeatures (quantile, scaled value, etc) are only populated for
             # specific data types.
-            meta_serialized = (
-                " (" + ", ".join(f"{k}:{v}" for k, v in meta.items()) + ")"
-            )
-            serialized += meta_serialized
+            parts.append(" (")
+            parts.append(", ".join(f"{k}:{v}" for k, v in meta.items()))
+            parts.append(")")
 
-        serialized += self.example_end_char
+        parts.append(self.example_end_char)
 
-        return serialized
+        return "".join(parts)
 
     def serialize_example(
         self,
@@ -389,19 +398,28 @@ class StructuredSerializer(RowSerializer):
 
     def serialize_key_and_value(self, k, v, meta: Dict[str, Any]) -> str:
         """Serialize an individual key-value pair."""
-        serialized = f"{self.key_start_token}{k}{self.key_end_token}{self.value_start_token}{v}{self.value_end_token}"
+        parts = [
+            self.key_start_token,
+            str(k),
+            self.key_end_token,
+            self.value_start_token,
+            str(v),
+            self.value_end_token,
+        ]
         if (
             meta
         ):  # TODO(jpgard): should we check data_args here to ensure metafeatures should be added?
             # Note that metafeatures will only be present for some features. This is because
             # most metafeatures (quantile, scaled value, etc) are only populated for
             # specific data types.
-            meta_serialized = "".join(
-                f"{self.meta_tokens[k]['start']}{v}{self.meta_tokens[k]['end']}"
-                for k, v in meta.items()
-            )
-            serialized += self.meta_start_token + meta_serialized + self.meta_end_token
-        return serialized
+            meta_tokens = self.meta_tokens
+            parts.append(self.meta_start_token)
+            for meta_k, meta_v in meta.items():
+                parts.append(meta_tokens[meta_k]["start"])
+                parts.append(str(meta_v))
+                parts.append(meta_tokens[meta_k]["end"])
+            parts.append(self.meta_end_token)
+        return "".join(parts)
 
     def serialize_example(
         self,
@@ -10,7 +10,12 @@ import unittest
 import numpy as np
 import pandas as pd
 
-from rtfm.datasets.data_utils import cast_columns_to_json_serializable, df_to_records
+from rtfm.datasets.data_utils import (
+    cast_columns_to_json_serializable,
+    df_to_records,
+    make_object_json_serializable,
+    unique_json_serializable_values,
+)
 
 
 class TestCastJSONSerializable(unittest.TestCase):
@@ -67,3 +72,21 @@ class TestCastJSONSerializable(unittest.TestCase):
     def test_df_to_records(self):
         records = df_to_records(self.df)
         self.assertTrue(all(isinstance(x, str) for x in records))
+
+
+class TestUniqueJSONSerializableValues(unittest.TestCase):
+    def test_matches_elementwise_conversion(self):
+        for ser in (
+            pd.Series([3, 1, 2, 1]),
+            pd.Series([1.5, np.nan, 1.5, 2.0]),
+            pd.Series([0.1, 0.2, 0.1], dtype="float32"),
+            pd.Series([-0.0, 0.0, 1.0]),
+            pd.Series([3, 1, 3], dtype="uint8"),
+            pd.Series([True, False, True]),
+            pd.Series([1, None, 2], dtype="Int64"),
+            pd.Series(["a", b"b", np.nan, "a"]),
+        ):
+            expected = ser.apply(make_object_json_serializable).unique()
+            self.assertListEqual(
+                list(unique_json_serializable_values(ser)), list(expected)
+            )
@@ -4,9 +4,22 @@ Tests for the evaluators module and related text-parsing functions.
 To run tests: python -m unittest rtfm/tests/test_evaluators.py -v
 
 """
+import os
+import sys
+import tempfile
 import unittest
+import unittest.mock
 
-from rtfm.generation_utils import parse_generated_text
+import torch
+
+from rtfm.arguments import DataArguments
+from rtfm.evaluation.evaluation_utils import iter_eval_datasets
+from rtfm.generation_utils import (
+    parse_generated_text,
+    CachedGenerationModel,
+    generate_in_batches,
+    VLLMGenerationModel,
+)
 from rtfm.special_tokens import QA_SEP_TOKEN, EOC_TOKEN
 
 
@@ -37,3 +50,243 @@ class TestParseGeneratedText(unittest.TestCase):
         self.assertEqual(parsed, COMPLETION_TEXT)
         self.assertTrue(is_valid)
         return
+
+
+class _CountingModel:
+    """Dummy model whose .generate() appends a single token to its inputs."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def generate(self, input_ids, attention_mask=None, max_new_tokens=1, **kwargs):
+        self.calls += 1
+        return torch.cat([input_ids, input_ids[:, -1:] + 1], dim=1)
+
+
+class TestCachedGenerationModel(unittest.TestCase):
+    def test_cache_hits_skip_generate(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model = CachedGenerationModel(
+                _CountingModel(),
+                cache_db=os.path.join(tmpdir, "cache.db"),
+                model_id="dummy",
+            )
+            input_ids = torch.LongTensor([[1, 2, 3]])
+            first = model.generate(input_ids, max_new_tokens=4)
+            second = model.generate(input_ids, max_new_tokens=4)
+            self.assertTrue(torch.equal(first, second))
+            self.assertEqual(model.model.calls, 1)
+
+            # Different generation kwargs are a cache miss.
+            model.generate(input_ids, max_new_tokens=8)
+            self.assertEqual(model.model.calls, 2)
+            model.close()
+
+    def test_cache_persists_across_instances(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_db = os.path.join(tmpdir, "cache.db")
+            input_ids = torch.LongTensor([[4, 5]])
+            model = CachedGenerationModel(
+                _CountingModel(), cache_db=cache_db, model_id="dummy"
+            )
+            expected = model.generate(input_ids)
+            model.close()
+
+            model = CachedGenerationModel(
+                _CountingModel(), cache_db=cache_db, model_id="dummy"
+            )
+            self.assertTrue(torch.equal(model.generate(input_ids), expected))
+            self.assertEqual(model.model.calls, 0)
+            model.close()
+
+
+class _DummyTokenizer:
+    pad_token_id = 0
+    eos_token_id = 0
+    model_max_length = 64
+
+    def __call__(self, text):
+        # Multi-token encoding, so that no keyword ids are used for stopping.
+        return unittest.mock.Mock(input_ids=[1, 2])
+
+
+class _PaddedBatchModel:
+    """Dummy model whose .generate() appends (last token + 1, eos) to each row,
+    then pads to max_new_tokens, as .generate() does for early-finished sequences."""
+
+    def __init__(self):
+        self.batch_shapes = []
+
+    def generate(self, input_ids, attention_mask, max_new_tokens, **kwargs):
+        self.batch_shapes.append(tuple(input_ids.shape))
+        assert (attention_mask.sum(dim=1) > 0).all()
+        completion = torch.zeros((len(input_ids), max_new_tokens), dtype=torch.long)
+        completion[:, 0] = input_ids[:, -1] + 1
+        return torch.cat([input_ids, completion], dim=1)
+
+
+class TestGenerateInBatches(unittest.TestCase):
+    def test_outputs_match_unbatched_order(self):
+        inputs = [
+            torch.LongTensor([5, 6, 7]),
+            torch.LongTensor([5]),
+            torch.LongTensor([5, 6, 7, 8, 9]),
+            torch.LongTensor([5, 6]),
+        ]
+        model = _PaddedBatchModel()
+        outputs = generate_in_batches(
+            model,
+            _DummyTokenizer(),
+            [(x, torch.ones_like(x)) for x in inputs],
+            max_new_tokens=4,
+            max_batch_size=2,
+        )
+        self.assertEqual(model.batch_shapes, [(2, 2), (2, 5)])
+        for x, output in zip(inputs, outputs):
+            expected = torch.cat([x, torch.LongTensor([x[-1] + 1, 0])])[None, :]
+            self.assertTrue(torch.equal(output, expected))
+
+    def test_duplicate_inputs_generated_once(self):
+        inputs = [
+            torch.LongTensor([5, 6, 7]),
+            torch.LongTensor([5, 6]),
+            torch.LongTensor([5, 6, 7]),
+            torch.LongTensor([5, 6, 7]),
+        ]
+        model = _PaddedBatchModel()
+        outputs = generate_in_batches(
+            model,
+            _DummyTokenizer(),
+            [(x, torch.ones_like(x)) for x in inputs],
+            max_new_tokens=4,
+            max_batch_size=4,
+        )
+        self.assertEqual(model.batch_shapes, [(2, 3)])
+        self.assertEqual(len(outputs), len(inputs))
+        for x, output in zip(inputs, outputs):
+            expected = torch.cat([x, torch.LongTensor([x[-1] + 1, 0])])[None, :]
+            self.assertTrue(torch.equal(output, expected))
+
+    def test_cache_is_per_input_across_batches(self):
+        a, b, c = (
+            torch.LongTensor([5, 6, 7]),
+            torch.LongTensor([5, 6]),
+            torch.LongTensor([8, 9]),
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model = CachedGenerationModel(
+                _PaddedBatchModel(),
+                cache_db=os.path.join(tmpdir, "cache.db"),
+                model_id="dummy",
+            )
+            first = generate_in_batches(
+                model,
+                _DummyTokenizer(),
+                [(x, torch.ones_like(x)) for x in (a, b)],
+                max_new_tokens=4,
+                max_batch_size=2,
+            )
+            # b is now in a batch with different neighbors; only c is generated.
+            second = generate_in_batches(
+                model,
+                _DummyTokenizer(),
+                [(x, torch.ones_like(x)) for x in (b, c)],
+                max_new_tokens=4,
+                max_batch_size=2,
+            )
+            self.assertEqual(model.model.batch_shapes, [(2, 3), (1, 2)])
+            self.assertTrue(torch.equal(first[1], second[0]))
+            expected = torch.cat([c, torch.LongTensor([10, 0])])[None, :]
+            self.assertTrue(torch.equal(second[1], expected))
+            self.assertEqual((model.hits, model.misses), (1, 3))
+            model.close()
+
+
+class TestVLLMGenerationModel(unittest.TestCase):
+    def _make_model(self):
+        fake_vllm = unittest.mock.MagicMock()
+
+        def _generate(prompts, sampling_params, use_tqdm):
+            # Complete each prompt with (last token + 1), then stop on token 99,
+            # which vllm does not include in the output token ids.
+            return [
+                unittest.mock.Mock(
+                    outputs=[
+                        unittest.mock.Mock(
+                            token_ids=[p["prompt_token_ids"][-1] + 1],
+                            stop_reason=99,
+                        )
+                    ]
+                )
+                for p in prompts
+            ]
+
+        fake_vllm.LLM.return_value.generate.side_effect = _generate
+        tokenizer = unittest.mock.MagicMock(pad_token_id=0)
+        tokenizer.return_value.input_ids = [99]
+
+        with unittest.mock.patch.dict(sys.modules, {"vllm": fake_vllm}):
+            model = VLLMGenerationModel(unittest.mock.MagicMock(), tokenizer)
+        return model, fake_vllm
+
+    def _check_generate(self, device):
+        model, fake_vllm = self._make_model()
+        self.assertEqual(model.stop_token_ids, [99])
+
+        input_ids = torch.LongTensor([[0, 0, 5, 6], [7, 8, 9, 10]]).to(device)
+        attention_mask = torch.LongTensor([[0, 0, 1, 1], [1, 1, 1, 1]]).to(device)
+        output = model.generate(input_ids, attention_mask=attention_mask)
+
+        prompts = fake_vllm.LLM.return_value.generate.call_args[0][0]
+        self.assertEqual(
+            prompts,
+            [{"prompt_token_ids": [5, 6]}, {"prompt_token_ids": [7, 8, 9, 10]}],
+        )
+        self.assertEqual(output.device, input_ids.device)
+        expected = torch.LongTensor([[0, 0, 5, 6, 7, 99], [7, 8, 9, 10, 11, 99]])
+        self.assertTrue(torch.equal(output.cpu(), expected))
+
+        # Outputs are combined with the inputs' device tensors in generate_in_batches.
+        generated = generate_in_batches(
+            model,
+            _DummyTokenizer(),
+            [(input_ids[1], attention_mask[1])],
+            max_new_tokens=4,
+            max_batch_size=1,
+        )
+        self.assertEqual(generated[0].device, input_ids.device)
+
+    def test_generate_strips_padding_and_appends_completions(self):
+        self._check_generate("cpu")
+
+    @unittest.skipUnless(torch.cuda.is_available(), "requires cuda")
+    def test_generate_returns_inputs_device_cuda(self):
+        self._check_generate("cuda")
+
+
+class TestIterEvalDatasets(unittest.TestCase):
+    def test_background_loader_uses_separate_tokenizer(self):
+        tokenizer = {"name": "tokenizer"}
+        tokenizers_used = []
+
+        def _prepare(task_name, data_arguments, splits_to_keep, tokenizer, **kwargs):
+            tokenizers_used.append(tokenizer)
+            return task_name
+
+        with unittest.mock.patch(
+            "rtfm.evaluation.evaluation_utils._prepare_task_eval_dataset",
+            side_effect=_prepare,
+        ):
+            outputs = list(
+                iter_eval_datasets(
+                    eval_task_names=["a", "b"],
+                    exclude_task_names=None,
+                    data_arguments=DataArguments(),
+                    tokenizer=tokenizer,
+                )
+            )
+        self.assertEqual(outputs, [("a_holdout", "a"), ("b_holdout", "b")])
+        self.assertEqual(len(tokenizers_used), 2)
+        for t in tokenizers_used:
+            self.assertEqual(t, tokenizer)
+            self.assertIsNot(t, tokenizer)
@@ -5,6 +5,7 @@ To run tests: python -m unittest rtfm/tests/test_inference.py -v
 """
 import logging
 import unittest
+import unittest.mock
 from dataclasses import dataclass
 from typing import List
 
@@ -15,6 +16,7 @@ from llama_recipes.inference.model_utils import load_model
 from tqdm import tqdm
 from transformers import AutoTokenizer
 
+import rtfm.inference_utils
 from rtfm.configs import TrainConfig, TokenizerConfig
 from rtfm.inference_utils import infer_on_example, InferenceModel
 from rtfm.serialization.serializers import get_serializer
@@ -239,6 +241,39 @@ class TestInferenceDummyModel(unittest.TestCase):
             rtol=0.04,
         )
 
+    def test_few_shot_examples_are_cached(self):
+        """Check that tokenized shots are reused only for identical labeled examples."""
+        labeled_examples = pd.DataFrame({"X1": [1, 0], "X2": [0, 1], "y": [0, 1]})
+        target_example = pd.DataFrame([{"X1": 1, "X2": 0}])
+
+        def _infer(labeled_examples):
+            infer_on_example(
+                model=self.model,
+                tokenizer=self.tokenizer,
+                serializer=self.serializer,
+                target_example=target_example,
+                target_colname="y",
+                target_choices=["0", "1"],
+                labeled_examples=labeled_examples,
+                handle_invalid_predictions="warn",
+            )
+
+        rtfm.inference_utils._SHOTS_CACHE.clear()
+        with unittest.mock.patch(
+            "rtfm.inference_utils._serialize_and_tokenize_examples",
+            wraps=rtfm.inference_utils._serialize_and_tokenize_examples,
+        ) as serialize_and_tokenize:
+            # Each miss serializes the shots and the target; each hit only the target.
+            _infer(labeled_examples)
+            self.assertEqual(serialize_and_tokenize.call_count, 2)
+            _infer(labeled_examples.copy())
+            self.assertEqual(serialize_and_tokenize.call_count, 3)
+            _infer(labeled_examples.assign(X2=[1, 1]))
+            self.assertEqual(serialize_and_tokenize.call_count, 5)
+            # bool and int values hash identically, but are serialized differently.
+            _infer(labeled_examples.astype({"X1": bool}))
+            self.assertEqual(serialize_and_tokenize.call_count, 7)
+
 
 class TestInferenceHelperTinyLlama(TestInferenceTinyLlama):
     """Test the InferenceHelper wrapper class with a small random-init llama model."""
@@ -0,0 +1,136 @@
+"""
+Tests for the serialize_interleave_and_shuffle pipeline.
+
+To run tests: python -m unittest rtfm/tests/test_serialize_interleave_and_shuffle.py -v
+
+"""
+import glob
+import itertools
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import pandas as pd
+import webdataset as wds
+
+from rtfm.arguments import DataArguments
+from rtfm.configs import SerializerConfig
+from rtfm.data import _extract_json_records
+from rtfm.pipelines.serialize_interleave_and_shuffle import (
+    ProcessFile,
+    _prefetch,
+    convert_to_wds,
+)
+
+
+class TestProcessFile(unittest.TestCase):
+    def test_keeps_non_ascii_records(self):
+        """Non-ASCII values are escaped in the JSON-encoded data, which can make it
+        much longer than the serialized text; such records must not be dropped."""
+        # Same data arguments as used in main().
+        data_args = DataArguments(
+            use_config=False,
+            feature_name_handling="none",
+            feature_value_handling="none",
+            targets_handling="none",
+        )
+        process_file = ProcessFile(data_args, SerializerConfig())
+        df = pd.DataFrame(
+            {
+                "text_feature": ["表" * 3000, "格" * 3000],
+                "label": ["yes", "no"],
+            }
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "table.parquet")
+            df.to_parquet(filename)
+            output = process_file.process_file(filename)
+        self.assertEqual(len(output), len(df))
+        self.assertTrue(all(len(x) <= process_file.max_chars for x in output["text"]))
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_yields_all_items(self):
+        self.assertListEqual(
+            list(_prefetch(range(10), max_prefetch=2)), list(range(10))
+        )
+
+    def test_reraises_reader_exception(self):
+        def _reader():
+            yield 0
+            yield 1
+            raise ValueError("read failed")
+
+        items = []
+        with self.assertRaisesRegex(ValueError, "read failed"):
+            for item in _prefetch(_reader()):
+                items.append(item)
+        self.assertListEqual(items, [0, 1])
+
+    def test_early_stop_joins_reader(self):
+        """A consumer that stops early must not hang on a blocked reader thread."""
+        num_threads = threading.active_count()
+        source = itertools.count()
+        prefetched = _prefetch(source, max_prefetch=2)
+        self.assertListEqual(list(itertools.islice(prefetched, 3)), [0, 1, 2])
+
+        # Close from a separate thread, so that a hang fails the test.
+        closer = threading.Thread(target=prefetched.close, daemon=True)
+        closer.start()
+        closer.join(timeout=10)
+        self.assertFalse(closer.is_alive())
+        self.assertEqual(threading.active_count(), num_threads)
+        # The reader stopped shortly after the consumer did.
+        self.assertLess(next(source), 10)
+
+
+class TestConvertToWds(unittest.TestCase):
+    def test_round_trip(self):
+        """Records written as packed JSONL samples are read back one by one."""
+        dfs = {
+            "a": pd.DataFrame({"text": [f"a{i}" for i in range(5)]}),
+            "b": pd.DataFrame({"text": [f"b{i}" for i in range(3)]}),
+        }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            parquet_files = []
+            for name, df in dfs.items():
+                parquet_files.append(os.path.join(tmpdir, f"{name}.parquet"))
+                df.to_parquet(parquet_files[-1])
+            os.makedirs(os.path.join(tmpdir, "test"))
+            convert_to_wds(
+                parquet_files,
+                index=0,
+                output_dir=tmpdir,
+                prefix="",
+                split="test",
+                read_batch_size=2,
+                rows_per_sample=2,
+            )
+            shards = glob.glob(os.path.join(tmpdir, "test", "*.tar"))
+            self.assertEqual(len(shards), 1)
+            samples = list(wds.WebDataset(shards[0], shardshuffle=False))
+            records = list(_extract_json_records(samples))
+
+        # The last sample of each file holds the remaining (fewer than
+        # rows_per_sample) records.
+        self.assertListEqual(
+            [x["__key__"] for x in samples],
+            ["a__0-1", "a__2-3", "a__4-4", "b__0-1", "b__2-2"],
+        )
+        self.assertListEqual(
+            records,
+            [{"text": x} for df in dfs.values() for x in df["text"]],
+        )
+
+    def test_reads_single_record_samples(self):
+        """Shards written with one JSON record per sample can still be read."""
+        records = [{"text": "x"}, {"text": "y"}]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shard = os.path.join(tmpdir, "shard.tar")
+            with wds.TarWriter(shard) as sink:
+                for i, record in enumerate(records):
+                    sink.write({"__key__": str(i), "json": json.dumps(record).encode()})
+            samples = list(wds.WebDataset(shard, shardshuffle=False))
+        self.assertListEqual(list(_extract_json_records(samples)), records)